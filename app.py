@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 from flask import Flask, request, jsonify, render_template, make_response
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 import gridfs
 import pytesseract
 from PIL import Image, ImageEnhance
 from bson.objectid import ObjectId
-from datetime import datetime
+from bson.errors import InvalidId
+from datetime import datetime, timedelta
 import pandas as pd
 import io
 import re
@@ -13,7 +14,12 @@ import cv2
 import numpy as np
 from dataclasses import dataclass, asdict
 from typing import Optional, Dict, List, Tuple
+from concurrent.futures import ProcessPoolExecutor
 import traceback
+import argparse
+import json
+import os
+import sys
 
 app = Flask(__name__)
 
@@ -452,6 +458,8 @@ class FieldExtractor:
 class BillOCRPipeline:
     """Pipeline chính"""
     
+    MAX_TEXT_LENGTH = 5000  # Giới hạn độ dài text lưu vào MongoDB
+    
     @staticmethod
     def process(image_bytes: bytes, bill_type: str) -> BillData:
         """Xử lý toàn bộ pipeline"""
@@ -476,11 +484,193 @@ class BillOCRPipeline:
             confidence_score=ocr_confidence,
             preprocessing_level=level,
             ocr_config_used=config_name,
-            ocr_raw_text=ocr_text[:5000],
-            ocr_corrected_text=corrected_text[:5000],
+            ocr_raw_text=ocr_text[:BillOCRPipeline.MAX_TEXT_LENGTH],
+            ocr_corrected_text=corrected_text[:BillOCRPipeline.MAX_TEXT_LENGTH],
             **extracted
         )
 
+# ============================================================================
+# RE-EXTRACTION
+# ============================================================================
+
+def _reextract_one(item: Tuple[str, str, str]) -> Tuple[str, str, Dict[str, Optional[str]]]:
+    """Chạy lại correction + extraction cho 1 bill (chạy trong worker process)"""
+    bill_id, bill_type, raw_text = item
+    corrected_text = TextCorrector.correct(raw_text)
+    extracted = FieldExtractor.extract(corrected_text, bill_type)
+    return bill_id, corrected_text[:BillOCRPipeline.MAX_TEXT_LENGTH], extracted
+
+
+def save_excel(data: Dict, filename: str):
+    """Tạo file Excel từ dữ liệu hóa đơn và lưu vào GridFS - Returns: excel_file_id"""
+    df = pd.DataFrame([data])
+    excel_buffer = io.BytesIO()
+    
+    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name='Bill Data')
+    
+    excel_buffer.seek(0)
+    excel_filename = f"{filename.rsplit('.', 1)[0]}_result.xlsx"
+    return fs.put(
+        excel_buffer, 
+        filename=excel_filename, 
+        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    )
+
+
+class BillReextractor:
+    """Chạy lại correction + extraction trên ocr_raw_text đã lưu, không OCR lại"""
+
+    DEFAULT_BATCH_SIZE = 200
+    MAX_BATCH_SIZE = 1000
+    DEFAULT_DIFF_LIMIT = 50
+    MAX_DIFF_LIMIT = 500
+
+    @staticmethod
+    def build_query(bill_type: Optional[str] = None, ids: Optional[List[str]] = None,
+                    date_from: Optional[str] = None, date_to: Optional[str] = None) -> Dict:
+        """Tạo filter MongoDB từ các tham số (date dạng YYYY-MM-DD, date_to tính cả ngày đó)"""
+        query = {'data.ocr_raw_text': {'$nin': [None, '']}}
+        if bill_type:
+            query['bill_type'] = bill_type
+        if ids is not None:
+            query['_id'] = {'$in': [ObjectId(i) for i in ids]}
+        if date_from or date_to:
+            query['upload_date'] = {}
+            if date_from:
+                query['upload_date']['$gte'] = datetime.strptime(date_from, '%Y-%m-%d')
+            if date_to:
+                query['upload_date']['$lt'] = datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)
+        return query
+
+    @staticmethod
+    def clamp(value, default: int, upper: int) -> int:
+        """Ép kiểu int và giới hạn trong [1, upper] (ValueError nếu không phải số)"""
+        if value is None:
+            value = default
+        if isinstance(value, bool):
+            raise ValueError(f"Invalid integer: {value!r}")
+        return max(1, min(int(value), upper))
+
+    @classmethod
+    def normalize_options(cls, batch_size=None, workers=None, diff_limit=None) -> Tuple[int, int, int]:
+        """Chuẩn hóa batch_size, workers, diff_limit về khoảng hợp lệ - Returns: (batch_size, workers, diff_limit)"""
+        cpu_count = os.cpu_count() or 1
+        return (
+            cls.clamp(batch_size, cls.DEFAULT_BATCH_SIZE, cls.MAX_BATCH_SIZE),
+            cls.clamp(workers, cpu_count, cpu_count),
+            cls.clamp(diff_limit, cls.DEFAULT_DIFF_LIMIT, cls.MAX_DIFF_LIMIT),
+        )
+
+    @staticmethod
+    def is_truncated(raw_text: str) -> bool:
+        """Text OCR đã bị cắt khi lưu -> trích xuất lại sẽ cho kết quả khác bản gốc"""
+        return len(raw_text) >= BillOCRPipeline.MAX_TEXT_LENGTH
+
+    @staticmethod
+    def diff(old_data: Dict, extracted: Dict[str, Optional[str]]) -> Dict[str, Dict]:
+        """So sánh field mới với dữ liệu đã lưu (None và '' coi như nhau) - Returns: {field: {'old': ..., 'new': ...}}"""
+        changes = {}
+        for field, new_value in extracted.items():
+            old_value = old_data.get(field)
+            if (old_value or '') != (new_value or ''):
+                changes[field] = {'old': old_value, 'new': new_value}
+        return changes
+
+    @staticmethod
+    def _iter_batches(cursor, batch_size: int):
+        batch = []
+        for bill in cursor:
+            batch.append(bill)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _record_change(summary: Dict, bill_id: str, entry: Dict, diff_limit: int):
+        if len(summary['changes']) < diff_limit:
+            summary['changes'][bill_id] = entry
+        else:
+            summary['changes_truncated'] = True
+
+    @classmethod
+    def _finalize_excel(cls, pending: Dict, summary: Dict, diff_limit: int):
+        """Chỉ giữ Excel mới cho bill đã thực sự được cập nhật, xóa Excel cũ của chúng và Excel mới của phần còn lại"""
+        confirmed = {b['_id'] for b in db.bills.find(
+            {'_id': {'$in': [p['bill']['_id'] for p in pending.values()]},
+             'excel_file_id': {'$in': [p['excel_file_id'] for p in pending.values()]}},
+            {'_id': 1}
+        )}
+        for bill_id, p in pending.items():
+            if p['bill']['_id'] in confirmed:
+                if p['old_excel_file_id']:
+                    fs.delete(p['old_excel_file_id'])
+                summary['updated'] += 1
+                cls._record_change(summary, bill_id, p['entry'], diff_limit)
+            else:
+                fs.delete(p['excel_file_id'])
+
+    @classmethod
+    def run(cls, query: Dict, dry_run: bool = True, batch_size: int = DEFAULT_BATCH_SIZE,
+            workers: Optional[int] = None, diff_limit: int = DEFAULT_DIFF_LIMIT) -> Dict:
+        """Xử lý theo batch trên nhiều core, ghi bằng bulk_write - Returns: summary + diff (tối đa diff_limit bill)"""
+        batch_size, workers, diff_limit = cls.normalize_options(batch_size, workers, diff_limit)
+
+        cursor = db.bills.find(query, {'bill_type': 1, 'filename': 1, 'excel_file_id': 1, 'data': 1})
+        cursor = cursor.batch_size(batch_size)
+        summary = {
+            'dry_run': dry_run, 'scanned': 0, 'changed': 0, 'updated': 0,
+            'skipped_truncated': 0, 'changes': {}, 'changes_truncated': False,
+        }
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for batch in cls._iter_batches(cursor, batch_size):
+                summary['scanned'] += len(batch)
+                stored = {}
+                for b in batch:
+                    if cls.is_truncated(b['data']['ocr_raw_text']):
+                        summary['skipped_truncated'] += 1
+                    else:
+                        stored[str(b['_id'])] = b
+                items = [(bill_id, b['bill_type'], b['data']['ocr_raw_text']) for bill_id, b in stored.items()]
+                chunksize = max(1, len(items) // (workers * 4))
+                results = executor.map(_reextract_one, items, chunksize=chunksize)
+
+                operations = []
+                pending = {}
+                for bill_id, corrected_text, extracted in results:
+                    bill = stored[bill_id]
+                    changes = cls.diff(bill['data'], extracted)
+                    text_changed = (bill['data'].get('ocr_corrected_text') or '') != corrected_text
+                    if not changes and not text_changed:
+                        continue
+                    summary['changed'] += 1
+                    entry = {'fields': changes, 'corrected_text_changed': text_changed}
+                    if dry_run:
+                        cls._record_change(summary, bill_id, entry, diff_limit)
+                        continue
+
+                    data = {**bill['data'], **extracted, 'ocr_corrected_text': corrected_text}
+                    update = {f'data.{field}': c['new'] for field, c in changes.items()}
+                    update['data.ocr_corrected_text'] = corrected_text
+                    # Excel cũ không còn khớp với data mới -> tạo lại
+                    update['excel_file_id'] = save_excel(data, bill.get('filename') or f'{bill_id}.jpg')
+                    pending[bill_id] = {'bill': bill, 'entry': entry, 'excel_file_id': update['excel_file_id'],
+                                        'old_excel_file_id': bill.get('excel_file_id')}
+                    operations.append(UpdateOne({'_id': bill['_id']}, {'$set': update}))
+
+                if operations:
+                    try:
+                        db.bills.bulk_write(operations, ordered=False)
+                    finally:
+                        cls._finalize_excel(pending, summary, diff_limit)
+                print(f"    Re-extracted {summary['scanned']} bills, {summary['changed']} changed, "
+                      f"{summary['skipped_truncated']} skipped (truncated text)", file=sys.stderr)
+
+        return summary
+
 # ============================================================================
 # FLASK ROUTES
 # ============================================================================
@@ -523,19 +713,7 @@ def upload_file():
         file_id = fs.put(file, filename=filename, content_type='image/jpeg')
         
         # Tạo Excel
-        df = pd.DataFrame([bill_data.to_dict()])
-        excel_buffer = io.BytesIO()
-        
-        with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Bill Data')
-        
-        excel_buffer.seek(0)
-        excel_filename = f"{filename.rsplit('.', 1)[0]}_result.xlsx"
-        excel_file_id = fs.put(
-            excel_buffer, 
-            filename=excel_filename, 
-            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        excel_file_id = save_excel(bill_data.to_dict(), filename)
         
         # Lưu vào MongoDB
         result = db.bills.insert_one({
@@ -590,6 +768,43 @@ def list_bills():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/bills/reextract', methods=['POST'])
+def reextract_bills():
+    """Chạy lại correction + extraction trên text OCR đã lưu (mặc định dry-run)"""
+    params = request.get_json(silent=True)
+    if params is None:
+        params = {}
+    if not isinstance(params, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    try:
+        ids = params.get('ids')
+        if ids is not None and not (isinstance(ids, list) and all(isinstance(i, str) for i in ids)):
+            raise ValueError('ids must be a list of strings')
+        bill_type = params.get('bill_type')
+        if bill_type is not None and bill_type not in FieldExtractor.PATTERNS:
+            raise ValueError(f'bill_type must be one of {list(FieldExtractor.PATTERNS)}')
+        dry_run = params.get('dry_run', True)
+        if not isinstance(dry_run, bool):
+            raise ValueError('dry_run must be a boolean')
+        query = BillReextractor.build_query(
+            bill_type=bill_type,
+            ids=ids,
+            date_from=params.get('date_from'),
+            date_to=params.get('date_to'),
+        )
+        batch_size, workers, diff_limit = BillReextractor.normalize_options(
+            params.get('batch_size'), params.get('workers'), params.get('diff_limit'))
+    except (ValueError, TypeError, InvalidId) as e:
+        return jsonify({'error': f'Invalid parameter: {e}'}), 400
+    
+    try:
+        summary = BillReextractor.run(query, dry_run=dry_run, batch_size=batch_size,
+                                      workers=workers, diff_limit=diff_limit)
+        return jsonify({'success': True, **summary})
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/bill/<id>', methods=['GET'])
 def get_bill(id):
     """Lấy chi tiết hóa đơn"""
@@ -667,5 +882,32 @@ def get_stats():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def reextract_cli(argv: Optional[List[str]] = None):
+    """CLI: python app.py reextract [--bill-type ...] [--apply]"""
+    parser = argparse.ArgumentParser(prog='app.py reextract',
+                                     description='Re-run text correction and field extraction on stored OCR text')
+    parser.add_argument('--bill-type', choices=list(FieldExtractor.PATTERNS.keys()))
+    parser.add_argument('--ids', nargs='+', help='Bill IDs to re-extract')
+    parser.add_argument('--date-from', help='Upload date from (YYYY-MM-DD)')
+    parser.add_argument('--date-to', help='Upload date to, inclusive (YYYY-MM-DD)')
+    parser.add_argument('--batch-size', type=int, default=BillReextractor.DEFAULT_BATCH_SIZE)
+    parser.add_argument('--workers', type=int, help='Worker processes (default: CPU count)')
+    parser.add_argument('--diff-limit', type=int, default=BillReextractor.DEFAULT_DIFF_LIMIT,
+                        help='Max number of per-bill diffs to print')
+    parser.add_argument('--apply', action='store_true', help='Write changes (default is dry-run diff)')
+    args = parser.parse_args(argv)
+
+    try:
+        query = BillReextractor.build_query(args.bill_type, args.ids, args.date_from, args.date_to)
+    except (ValueError, InvalidId) as e:
+        parser.error(str(e))
+    summary = BillReextractor.run(query, dry_run=not args.apply,
+                                  batch_size=args.batch_size, workers=args.workers,
+                                  diff_limit=args.diff_limit)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'reextract':
+        reextract_cli(sys.argv[2:])
+    else:
+        app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
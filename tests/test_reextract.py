@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+from datetime import datetime
+
+import pytest
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import app  # noqa: E402
+
+WATER_TEXT = 'Mã khách hàng: AB123 Tổng cộng 12.000 Số tiền bằng chữ: Mười hai nghìn đồng'
+
+
+def stored_data(raw_text, bill_type='water'):
+    """Dữ liệu như khi upload: extraction trên text đầy đủ, lưu text bị cắt"""
+    corrected = app.TextCorrector.correct(raw_text)
+    return {
+        **app.FieldExtractor.extract(corrected, bill_type),
+        'ocr_raw_text': raw_text[:app.BillOCRPipeline.MAX_TEXT_LENGTH],
+        'ocr_corrected_text': corrected[:app.BillOCRPipeline.MAX_TEXT_LENGTH],
+    }
+
+
+class FakeCursor(list):
+    def batch_size(self, n):
+        return self
+
+
+class FakeBills:
+    def __init__(self, docs):
+        self.docs = docs
+        self.operations = []
+        self.fail_write = False
+
+    def find(self, query, projection):
+        docs = self.docs
+        for key in ('_id', 'excel_file_id'):
+            if key in query:
+                docs = [d for d in docs if d.get(key) in query[key]['$in']]
+        return FakeCursor(docs)
+
+    def bulk_write(self, operations, ordered=True):
+        if self.fail_write:
+            raise RuntimeError('write failed')
+        self.operations.extend(operations)
+        for op in operations:
+            for doc in self.docs:
+                if doc['_id'] == op._filter['_id']:
+                    for key, value in op._doc['$set'].items():
+                        if key.startswith('data.'):
+                            doc['data'][key[len('data.'):]] = value
+                        else:
+                            doc[key] = value
+
+
+@pytest.fixture
+def fake_fs(monkeypatch):
+    """GridFS giả: save_excel trả về id mới, ghi lại các file bị xóa"""
+    created, deleted = [], []
+
+    def save_excel(data, filename):
+        created.append(ObjectId())
+        return created[-1]
+
+    monkeypatch.setattr(app, 'save_excel', save_excel)
+    monkeypatch.setattr(app, 'fs', type('FS', (), {'delete': staticmethod(deleted.append)})())
+    return created, deleted
+
+
+def changed_bill(**extra):
+    data = stored_data(WATER_TEXT)
+    data['customer_code'] = 'OLD'
+    return {'_id': ObjectId(), 'bill_type': 'water', 'filename': 'bill.jpg',
+            'excel_file_id': ObjectId(), 'data': data, **extra}
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    def install(docs):
+        bills = FakeBills(docs)
+        monkeypatch.setattr(app, 'db', type('DB', (), {'bills': bills})())
+        return bills
+    return install
+
+
+def test_build_query_date_to_inclusive_and_ids():
+    bill_id = str(ObjectId())
+    query = app.BillReextractor.build_query('water', [bill_id], '2025-01-01', '2025-01-31')
+    assert query['bill_type'] == 'water'
+    assert query['_id'] == {'$in': [ObjectId(bill_id)]}
+    assert query['upload_date'] == {'$gte': datetime(2025, 1, 1), '$lt': datetime(2025, 2, 1)}
+
+
+def test_build_query_rejects_invalid_input():
+    with pytest.raises(InvalidId):
+        app.BillReextractor.build_query(ids=['not-an-id'])
+    with pytest.raises(ValueError):
+        app.BillReextractor.build_query(date_from='01/01/2025')
+
+
+def test_build_query_empty_ids_matches_nothing():
+    assert app.BillReextractor.build_query(ids=[])['_id'] == {'$in': []}
+
+
+def test_diff_treats_none_and_empty_as_equal():
+    changes = app.BillReextractor.diff({'usage': None, 'vat_rate': '10'}, {'usage': '', 'vat_rate': '8'})
+    assert changes == {'vat_rate': {'old': '10', 'new': '8'}}
+
+
+def test_diff_unchanged_rules_has_no_changes():
+    data = stored_data(WATER_TEXT)
+    _, _, extracted = app._reextract_one(('id', 'water', data['ocr_raw_text']))
+    assert app.BillReextractor.diff(data, extracted) == {}
+
+
+def test_iter_batches():
+    batches = list(app.BillReextractor._iter_batches(iter(range(5)), 2))
+    assert batches == [[0, 1], [2, 3], [4]]
+
+
+def test_clamp():
+    clamp = app.BillReextractor.clamp
+    assert clamp(None, 4, 8) == 4
+    assert clamp('3', 4, 8) == 3
+    assert clamp(10000, 4, 8) == 8
+    assert clamp(-5, 4, 8) == 1
+    with pytest.raises(ValueError):
+        clamp('x', 4, 8)
+
+
+def test_normalize_options_diff_limit_lower_bound():
+    batch_size, workers, diff_limit = app.BillReextractor.normalize_options(0, 0, 0)
+    assert (batch_size, workers, diff_limit) == (1, 1, 1)
+
+
+def test_run_skips_truncated_text(fake_db):
+    long_text = 'x ' * 3000 + WATER_TEXT
+    bills = fake_db([{'_id': ObjectId(), 'bill_type': 'water', 'data': stored_data(long_text)}])
+    summary = app.BillReextractor.run({}, dry_run=False, workers=1)
+    assert summary['skipped_truncated'] == 1
+    assert summary['changed'] == 0
+    assert bills.operations == []
+
+
+def test_run_dry_run_limits_diffs(fake_db):
+    docs = []
+    for _ in range(3):
+        data = stored_data(WATER_TEXT)
+        data['customer_code'] = 'OLD'
+        docs.append({'_id': ObjectId(), 'bill_type': 'water', 'data': data})
+    bills = fake_db(docs)
+    summary = app.BillReextractor.run({}, dry_run=True, workers=1, diff_limit=2)
+    assert summary['changed'] == 3
+    assert summary['changes_truncated'] is True
+    assert len(summary['changes']) == 2
+    entry = next(iter(summary['changes'].values()))
+    assert entry == {'fields': {'customer_code': {'old': 'OLD', 'new': 'AB123'}}, 'corrected_text_changed': False}
+    assert bills.operations == []
+
+
+def test_run_apply_regenerates_excel(fake_db, fake_fs):
+    created, deleted = fake_fs
+    docs = [changed_bill(), changed_bill()]
+    old_excel_ids = [d['excel_file_id'] for d in docs]
+    bills = fake_db(docs)
+
+    summary = app.BillReextractor.run({}, dry_run=False, workers=1, diff_limit=1)
+    assert summary['updated'] == 2
+    assert summary['changes'] == {str(docs[0]['_id']): {
+        'fields': {'customer_code': {'old': 'OLD', 'new': 'AB123'}}, 'corrected_text_changed': False}}
+    assert summary['changes_truncated'] is True
+    assert [d['data']['customer_code'] for d in bills.docs] == ['AB123', 'AB123']
+    assert [d['excel_file_id'] for d in bills.docs] == created
+    assert deleted == old_excel_ids
+
+
+def test_run_apply_failed_write_removes_new_excel(fake_db, fake_fs):
+    created, deleted = fake_fs
+    doc = changed_bill()
+    old_excel_id = doc['excel_file_id']
+    bills = fake_db([doc])
+    bills.fail_write = True
+
+    with pytest.raises(RuntimeError):
+        app.BillReextractor.run({}, dry_run=False, workers=1)
+    assert deleted == created
+    assert doc['excel_file_id'] == old_excel_id
+
+
+def test_run_apply_bill_deleted_after_find(fake_db, fake_fs):
+    created, deleted = fake_fs
+    doc = changed_bill()
+    bills = fake_db([doc])
+    bills.find = lambda query, projection, find=bills.find: (
+        find(query, projection) if '_id' not in query else FakeCursor())
+
+    summary = app.BillReextractor.run({}, dry_run=False, workers=1)
+    assert summary['updated'] == 0
+    assert summary['changes'] == {}
+    assert deleted == created
+
+
+def test_reextract_route_empty_ids_targets_nothing(fake_db, fake_fs):
+    created, deleted = fake_fs
+    bills = fake_db([changed_bill()])
+    response = app.app.test_client().post('/bills/reextract', json={'ids': [], 'dry_run': False})
+    assert response.status_code == 200
+    assert response.get_json()['scanned'] == 0
+    assert bills.operations == [] and created == [] and deleted == []
+
+
+@pytest.mark.parametrize('body', [
+    {'workers': 'x'},
+    {'batch_size': 'x'},
+    {'ids': 'abc'},
+    {'ids': ['not-an-id']},
+    {'date_from': '2025/01/01'},
+    {'dry_run': 'false'},
+    {'bill_type': 'gas'},
+    [1],
+    'x',
+])
+def test_reextract_route_rejects_bad_params(body):
+    response = app.app.test_client().post('/bills/reextract', json=body)
+    assert response.status_code == 400